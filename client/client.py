@@ -2,15 +2,44 @@
 
 import logging
 import os
+import random
+import selectors
 import time
-from socket import AF_INET, SHUT_RDWR, SOCK_STREAM, socket
+from socket import (
+    AF_INET,
+    IPPROTO_TCP,
+    SHUT_RDWR,
+    SO_KEEPALIVE,
+    SO_RCVBUF,
+    SO_SNDBUF,
+    SOCK_STREAM,
+    SOL_SOCKET,
+    TCP_KEEPCNT,
+    TCP_KEEPIDLE,
+    TCP_KEEPINTVL,
+    TCP_NODELAY,
+    socket,
+)
 from types import UnionType
-from typing import get_args, overload
-
-from pydantic import BaseModel
-
-from client.common import DeterminationT, expect, read_message, send_model
-from client.const import RECONNECT_DELAY
+from typing import Any, cast, overload
+
+from client.common import (
+    DeterminationT,
+    MessageBuffer,
+    expect,
+    flush,
+    read_message,
+    send_model,
+)
+from client.const import (
+    KEEPALIVE_COUNT,
+    KEEPALIVE_IDLE,
+    KEEPALIVE_INTERVAL,
+    RECONNECT_DELAY,
+    RECONNECT_DELAY_MAX,
+    RECONNECT_JITTER,
+    SOCKET_BUFFER_SIZE,
+)
 from client.shell import Shell
 from client.typedefs import (
     AckMessage,
@@ -23,17 +52,33 @@ from client.typedefs import (
 log = logging.getLogger(__name__)
 
 
-class Client(BaseModel):
+class Client:
     """Client for the Llama connection."""
 
+    __slots__ = (
+        '_outbox',
+        '_received',
+        '_reconnect_delay',
+        '_selector',
+        '_shell',
+        '_socket',
+    )
+
     _shell: Shell
-    _data: bytes = b''
-    _socket: socket | None = None
+    _received: MessageBuffer
+    _socket: socket | None
+    _outbox: list[bytes]
+    _selector: selectors.BaseSelector
+    _reconnect_delay: float
 
     def __init__(self, shell: Shell) -> None:
         """Initialize the client."""
-        super().__init__()
         self._shell = shell
+        self._received = MessageBuffer()
+        self._socket = None
+        self._outbox = []
+        self._selector = selectors.DefaultSelector()
+        self._reconnect_delay = RECONNECT_DELAY
 
     def connect(self) -> None:
         """Connect to the Llama server."""
@@ -44,8 +89,11 @@ class Client(BaseModel):
                 log.warning('Connection closed')
                 log.debug(e)
             self._socket = None
-            log.info(f'Waiting {RECONNECT_DELAY}s before reconnecting')
-            time.sleep(RECONNECT_DELAY)
+            delay = self._reconnect_delay
+            delay += random.uniform(0, delay * RECONNECT_JITTER)  # noqa: S311 Not for crypto
+            log.info('Waiting %.2fs before reconnecting', delay)
+            time.sleep(delay)
+            self._reconnect_delay = min(self._reconnect_delay * 2, RECONNECT_DELAY_MAX)
 
     def cleanup(self) -> None:
         """Close the client."""
@@ -61,23 +109,54 @@ class Client(BaseModel):
         """Connect to the Llama server."""
         port = int(os.getenv('LLAMA_PORT', '1199'))
 
-        with socket(AF_INET, SOCK_STREAM) as self._socket:
-            log.info(f'Connecting to host.docker.internal:{port}')
+        with socket(AF_INET, SOCK_STREAM) as sock:
+            self._socket = sock
+            log.info('Connecting to host.docker.internal:%s', port)
             self._socket.settimeout(1)
+            # Has to happen before connecting for the window scaling to pick it up
+            self._socket.setsockopt(SOL_SOCKET, SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            self._socket.setsockopt(SOL_SOCKET, SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            # Notice a dead server within seconds instead of the default two hours
+            self._socket.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+            self._socket.setsockopt(IPPROTO_TCP, TCP_KEEPIDLE, KEEPALIVE_IDLE)
+            self._socket.setsockopt(IPPROTO_TCP, TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+            self._socket.setsockopt(IPPROTO_TCP, TCP_KEEPCNT, KEEPALIVE_COUNT)
             self._socket.connect(('host.docker.internal', port))
-
-            send_model(self._socket, SynMessage())
-            _ = self._expect(AckMessage)
-            send_model(self._socket, AckMessage())
-            log.info('Connected to server')
-
-            self._socket.settimeout(None)
+            # Messages are batched in the outbox, so Nagle would only add latency
+            self._socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            self._received.clear()
+            self._outbox.clear()
+            _ = self._selector.register(sock, selectors.EVENT_READ)
             try:
-                self._handle_commands()
-            except ConnectionError:
-                log.exception('Connection closed')
+                self._handshake()
+                try:
+                    self._handle_commands()
+                except ConnectionError:
+                    log.exception('Connection closed')
+            finally:
+                # Might already be closed by cleanup, the selector still finds it
+                _ = self._selector.unregister(sock)
         self._socket = None
 
+    def _handshake(self) -> None:
+        """Exchange SYN and ACK with the server."""
+        send_model(self._socket, SynMessage(), self._outbox)
+        _ = self._expect(AckMessage)
+        send_model(self._socket, AckMessage(), self._outbox)
+        log.info('Connected to server')
+        self._reconnect_delay = RECONNECT_DELAY
+        if self._socket:
+            self._socket.settimeout(None)
+
+    def _wait_readable(self) -> None:
+        """Wait until the server has sent data, honoring the socket timeout."""
+        if self._socket is None:
+            _err = 'Connection closed'
+            raise ConnectionError(_err)
+        if not self._selector.select(self._socket.gettimeout()):
+            _err = 'timed out'
+            raise TimeoutError(_err)
+
     @overload
     def _expect(self, what: type[UnionType]) -> AnyResult: ...
     @overload
@@ -85,23 +164,23 @@ class Client(BaseModel):
 
     def _expect(self, what):
         """Expect a message type."""
-        message = expect(read_message(self._socket), what, log.debug)
-        if message in get_args(FinMessage):
+        # Everything queued so far has to go out before blocking on the answer
+        flush(self._socket, self._outbox)
+        data = read_message(self._socket, self._received, wait=self._wait_readable)
+        # The server may send FIN instead of whatever was expected
+        message = expect(data, what | FinMessage, log.debug)
+        if isinstance(message, FinMessage):
             _err = 'FIN received'
             log.warning(_err)
             self.cleanup()
             raise ConnectionError(_err)
-        return message
+        # Anything but FIN is what the caller asked for
+        return cast('Any', message)
 
     def _handle_commands(self) -> None:
         """Handle commands from the server."""
         while True:
             command = self._expect(AnyServerRuntimeMessage)
-            if isinstance(command, FinMessage):
-                log.warning('Received FIN from server')
-                self.cleanup()
-                _err = 'Connection closed'
-                raise ConnectionError(_err)
             result = self._shell.execute(command)
-            log.debug(f'Sending result: {result}')
-            send_model(self._socket, result)
+            log.debug('Sending result: %s', result)
+            send_model(self._socket, result, self._outbox)
@@ -3,34 +3,37 @@
 import json
 import logging
 import os
-import random
-import string
+import struct
 from collections.abc import Callable
-from contextlib import suppress
+from functools import cache
+from heapq import merge
 from inspect import isclass
+from operator import itemgetter
 from pathlib import Path
 from socket import socket
 from types import UnionType
-from typing import TypeVar, get_args, get_origin, overload
+from typing import Annotated, TypeVar, Union, cast, get_args, get_origin, overload
 
 import coloredlogs
 import termcolor
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, Discriminator, Tag, TypeAdapter
+from pydantic_core import from_json
 from termcolor._types import Color
 
-from client.const import COLORS
+from client.const import COLORS, RECV_BUFFER_SIZE
 from client.typedefs import (
     AnyMessage,
     AnyResult,
     FileReadResult,
     FileWriteResult,
     ShellResult,
+    message_kind,
 )
 
-
-def random_string(length: int) -> str:
-    """Generate a random string."""
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))  # noqa: S311
+# Scratch buffer for recv_into, both processes only ever read from one socket at a time
+_recv_buffer = memoryview(bytearray(RECV_BUFFER_SIZE))
+# Every message is prefixed with its length as a 4-byte big-endian integer
+_header = struct.Struct('>I')
 
 
 def fd_path(name: str) -> Path:
@@ -43,20 +46,30 @@ def fd_path(name: str) -> Path:
         raise FileNotFoundError(_err) from e
 
 
+@cache
+def _ansi(color: Color) -> tuple[str, str]:
+    """Get the escape sequences that termcolor wraps a string in."""
+    prefix, _, suffix = termcolor.colored('\0', color, force_color=True).partition('\0')
+    return prefix, suffix
+
+
 def colored(text: str | None, color: Color) -> str:
     """Color a string."""
     if not text:
         return ''
-    return termcolor.colored(text, color, force_color=True)
+    prefix, suffix = _ansi(color)
+    return f'{prefix}{text}{suffix}'
 
 
 def log_output(method, result: AnyResult) -> None:
     """Log the output of a command."""
     if isinstance(result, ShellResult):
-        stdout = [(*v, COLORS.stdout) for v in result.stdout]
-        stderr = [(*v, COLORS.stderr) for v in result.stderr]
-        for line in sorted(stdout + stderr, key=lambda x: x[0]):
-            method(colored(line[1].rstrip('\n'), line[-1]))
+        stdout_color, stderr_color = COLORS.stdout, COLORS.stderr
+        stdout = ((t, line, stdout_color) for t, line in result.stdout)
+        stderr = ((t, line, stderr_color) for t, line in result.stderr)
+        # Both streams are already in timestamp order
+        for _, line, color in merge(stdout, stderr, key=itemgetter(0)):
+            method(colored(line.rstrip('\n'), color))
         if result.exit_code:
             method(colored(f'Exited with code {result.exit_code}', COLORS.stderr))
 
@@ -64,16 +77,16 @@ def log_output(method, result: AnyResult) -> None:
         if not result.error:
             content = result.content or ''
             method(colored(f'Read {len(content)}B from {result.file}', COLORS.stdout))
-            for line in content.splitlines():
-                method(colored(line, COLORS.stdout))
+            if content:
+                method(colored(content.rstrip('\n'), COLORS.stdout))
         else:
             method(colored(result.error, COLORS.stderr))
 
     elif isinstance(result, FileWriteResult):
         if not result.error:
             method(colored(f'Wrote {result.written}B to {result.file}', COLORS.stdout))
-            for line in result.command.content.splitlines():
-                method(colored(line, COLORS.stdout))
+            if result.command.content:
+                method(colored(result.command.content.rstrip('\n'), COLORS.stdout))
         else:
             method(colored(result.error, COLORS.stderr))
 
@@ -97,57 +110,134 @@ def install_coloredlogs(log: logging.Logger | None = None) -> None:
 DeterminationT = TypeVar('DeterminationT', bound=AnyMessage)
 
 
+@cache
+def _adapter(as_a: type | UnionType) -> TypeAdapter:
+    """Get the type adapter for a message type, dispatching unions on the message kind."""
+    if get_origin(as_a) == UnionType:
+        tagged = tuple(Annotated[v, Tag(v.__name__)] for v in get_args(as_a))
+        return TypeAdapter(Annotated[Union[tagged], Discriminator(message_kind)])  # noqa: UP007 Runtime tuple
+    if isclass(as_a) and issubclass(as_a, AnyMessage):
+        return TypeAdapter(as_a)
+    _err = f'Invalid message type: {as_a}'
+    raise ValueError(_err)
+
+
 def _determine(
-    what: str | dict, as_a: type[DeterminationT], log_method: Callable[[str], None]
+    what: str | dict, as_a: type[DeterminationT], log_method: Callable[..., None]
 ) -> DeterminationT:
-    ret = as_a.model_validate(what) if isinstance(what, dict) else as_a.model_validate_json(what)
-    log_method(f'Determined {ret.__class__.__name__}: {ret}')
+    # Parse only once, validate_json would convert the whole message again for the discriminator
+    obj = what if isinstance(what, dict) else from_json(what)
+    # The TypeVar hides that message classes and unions of them are hashable
+    ret = _adapter(cast('type', as_a)).validate_python(obj)
+    log_method('Determined %s: %s', ret.__class__.__name__, ret)
     return ret
 
 
 @overload
 def expect(
-    what: str | dict, as_a: type[UnionType], log_method: Callable[[str], None]
+    what: str | dict, as_a: type[UnionType], log_method: Callable[..., None]
 ) -> AnyMessage: ...
 @overload
 def expect(
-    what: str | dict, as_a: type[DeterminationT], log_method: Callable[[str], None]
+    what: str | dict, as_a: type[DeterminationT], log_method: Callable[..., None]
 ) -> DeterminationT: ...
 
 
 def expect(what, as_a, log_method):
     """Determine the type of object."""
-    if get_origin(as_a) == UnionType:
-        for v in get_args(as_a):
-            with suppress(ValidationError):
-                return _determine(what, v, log_method)
-        _err = f'No valid type found for {what} in {as_a}'
-    elif isclass(as_a) and issubclass(as_a, AnyMessage):
-        return _determine(what, as_a, log_method)
-    _err = f'Invalid object: {what}'
-    raise ValueError(_err)
-
-
-def send_model(sock: socket | None, model: BaseModel) -> None:
-    """Send a model to a socket."""
+    return _determine(what, as_a, log_method)
+
+
+def _send_buffers(sock: socket, buffers: list[bytes]) -> None:
+    """Send all buffers, gathering them into as few syscalls as possible."""
+    if not hasattr(sock, 'sendmsg'):
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    views = [memoryview(buf) for buf in buffers]
+    while views:
+        # Unlike sendall, sendmsg may return after a partial write
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def send_model(sock: socket | None, model: BaseModel, outbox: list[bytes] | None = None) -> None:
+    """Send a model to a socket, or queue it in the outbox until the next flush."""
     if sock is None:
         _err = 'Connection closed'
         raise ConnectionError(_err)
-    sock.sendall(model.model_dump_json().encode('utf-8') + b'\0')
-
-
-def read_message(sock: socket | None) -> str:
-    """Read a message from the connection."""
-    buf = b''
+    # Serializes straight to UTF-8 bytes, without going through an intermediate str
+    payload = _adapter(type(model)).dump_json(model)
+    frame = [_header.pack(len(payload)), payload]
+    if outbox is not None:
+        outbox.extend(frame)
+        return
+    _send_buffers(sock, frame)
+
+
+def flush(sock: socket | None, outbox: list[bytes]) -> None:
+    """Send all queued messages at once."""
+    if not outbox:
+        return
+    if sock is None:
+        _err = 'Connection closed'
+        raise ConnectionError(_err)
+    _send_buffers(sock, outbox)
+    outbox.clear()
+
+
+class MessageBuffer:
+    """Bytes received on a connection that have not been returned as a message yet."""
+
+    __slots__ = ('_data',)
+
+    def __init__(self) -> None:
+        """Initialize an empty buffer."""
+        self._data = bytearray()
+
+    def feed(self, data: memoryview | bytes) -> None:
+        """Append received bytes."""
+        self._data.extend(data)
+
+    def pop(self) -> str | None:
+        """Remove and return the first complete message, if there is one."""
+        if len(self._data) < _header.size:
+            return None
+        (length,) = _header.unpack_from(self._data)
+        end = _header.size + length
+        if len(self._data) < end:
+            return None
+        message = self._data[_header.size : end].decode('utf-8')
+        del self._data[:end]
+        return message
+
+    def clear(self) -> None:
+        """Drop everything received so far."""
+        self._data.clear()
+
+
+def read_message(
+    sock: socket | None,
+    buffer: MessageBuffer,
+    wait: Callable[[], None] | None = None,
+) -> str:
+    """Read a message from the connection.
+
+    Anything received after the message stays in the buffer for the next call. The wait
+    callback is run before blocking on the socket.
+    """
     if sock is None:
         _err = 'Connection closed'
         raise ConnectionError(_err)
-    while True:
-        data = sock.recv(4096)
-        if not data:
+    while (message := buffer.pop()) is None:
+        if wait:
+            wait()
+        n = sock.recv_into(_recv_buffer)
+        if not n:
             _err = 'Connection closed'
             raise ConnectionError(_err)
-        buf += data
-        if b'\0' in buf:
-            message, buf = buf.split(b'\0', 1)
-            return message.decode('utf-8')
+        buffer.feed(_recv_buffer[:n])
+    return message
@@ -11,12 +11,41 @@ from bashlex.tokenizer import MatchedPairError
 
 from client.typedefs import TerminalColors
 
-SHELL_INTERACTIVE_COMMANDS = [
-    'vim',
-    'nano',
-    'less',
-    'more',
-]
+SHELL_INTERACTIVE_COMMANDS = frozenset(
+    [
+        'vim',
+        'nano',
+        'less',
+        'more',
+    ]
+)
+# Output of `compgen -k`, a line made of these is only valid bash as part of a larger construct
+SHELL_RESERVED_WORDS = frozenset(
+    [
+        'if',
+        'then',
+        'else',
+        'elif',
+        'fi',
+        'case',
+        'esac',
+        'for',
+        'select',
+        'while',
+        'until',
+        'do',
+        'done',
+        'in',
+        'function',
+        'time',
+        '{',
+        '}',
+        '!',
+        '[[',
+        ']]',
+        'coproc',
+    ]
+)
 
 # CLEANUPS: list[tuple[str, str]] = [
 #    (r'```(python)?(.*?)```', r'\2'),
@@ -30,7 +59,17 @@ USERTYPES = {
 
 EXIT_TIMEOUT = float(os.getenv('LLAMA_EXIT_TIMEOUT', '10.0'))
 KILL_TIMEOUT = 1.0
+PARSE_CACHE_SIZE = 1024
+PROMPT_FD_MIN = 100
 RECONNECT_DELAY = 1.0
+RECONNECT_DELAY_MAX = 30.0
+RECONNECT_JITTER = 0.1
+RECV_BUFFER_SIZE = 1 << 16
+READ_BUFFER_SIZE = 1 << 17
+SOCKET_BUFFER_SIZE = 1 << 20
+KEEPALIVE_IDLE = 15
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
 
 LEXER_ERRORS: dict[type, int] = {
     MatchedPairError: 2,
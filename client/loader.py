@@ -25,28 +25,45 @@ httpx_logger.setLevel(logging.WARNING)
 POCKET_ASI_MODULE = os.environ['POCKET_ASI_MODULE']
 POCKET_ASI_FILES = json.loads(os.environ['POCKET_ASI_FILES'])
 log.info(f'Received {len(POCKET_ASI_FILES)} files as FDs')
+# find_spec runs for every import in the process, so map full module names to FDs up front
+MODULE_FDS = {
+    f'{POCKET_ASI_MODULE}.{name.removesuffix(".py")}': fd
+    for name, fd in POCKET_ASI_FILES.items()
+    if name.endswith('.py')
+}
+if '__init__.py' in POCKET_ASI_FILES:
+    MODULE_FDS[POCKET_ASI_MODULE] = POCKET_ASI_FILES['__init__.py']
 
 
 class FDLoader(importlib.abc.SourceLoader):
     """Loader for file descriptors."""
 
     fd: int
+    _data: bytes | None
 
     def __init__(self, fd: int):
         """Initialize the loader with a file descriptor."""
         self.fd = fd
+        self._data = None
 
     def get_data(self, path: str) -> bytes:
         """Read the content of the file descriptor."""
         _ = path
-        _ = os.lseek(self.fd, 0, os.SEEK_SET)
-        content = b''
-        while True:
-            chunk = os.read(self.fd, 4096)
+        # Keep serving the source the module was imported from, e.g. for tracebacks
+        if self._data is not None:
+            return self._data
+        size = os.fstat(self.fd).st_size
+        # A single pread for the whole file, looping only in case it comes back short
+        chunks = []
+        offset = 0
+        while offset < size:
+            chunk = os.pread(self.fd, size - offset, offset)
             if not chunk:
                 break
-            content += chunk
-        return content
+            chunks.append(chunk)
+            offset += len(chunk)
+        self._data = b''.join(chunks)
+        return self._data
 
     def get_filename(self, fullname: str) -> str:
         """Return the filename of the file descriptor."""
@@ -61,6 +78,12 @@ class FDLoader(importlib.abc.SourceLoader):
 class FDFinder(importlib.abc.MetaPathFinder):
     """Finder for file descriptors."""
 
+    _loaders: dict[int, FDLoader]
+
+    def __init__(self):
+        """Initialize the finder without any loaders."""
+        self._loaders = {}
+
     def find_spec(
         self,
         fullname: str,
@@ -70,15 +93,13 @@ class FDFinder(importlib.abc.MetaPathFinder):
         """Find the FD for a module."""
         _ = path, target
 
-        if fullname == POCKET_ASI_MODULE:
-            module_name = '__init__.py'
-        elif fullname.startswith(POCKET_ASI_MODULE):
-            module_name = f'{fullname.split('.')[-1]}.py'
-        else:
-            return None
-        if module_name in POCKET_ASI_FILES:
-            fd = POCKET_ASI_FILES[module_name]
-            spec = importlib.machinery.ModuleSpec(fullname, FDLoader(fd), origin=f'fd:/{fd}')
+        fd = MODULE_FDS.get(fullname)
+        if fd is not None:
+            # Reused so the source it read is kept; specs are built fresh since importlib
+            # mutates them while loading
+            if fd not in self._loaders:
+                self._loaders[fd] = FDLoader(fd)
+            spec = importlib.machinery.ModuleSpec(fullname, self._loaders[fd], origin=f'fd:/{fd}')
             spec.submodule_search_locations = []
             if fullname.endswith('.__init__'):
                 if not spec.origin:
@@ -1,16 +1,16 @@
 """Interactive shell."""
 
+import fcntl
 import os
 import re
+import selectors
 import subprocess
-import tempfile
-import threading
 import time
-from contextlib import contextmanager, suppress
+from collections.abc import Callable
+from contextlib import suppress
+from functools import lru_cache
 from pathlib import Path
-from queue import Queue
-from select import select
-from typing import IO, overload
+from typing import IO, Any, overload
 
 import bashlex
 import bashlex.ast
@@ -18,16 +18,20 @@ import bashlex.errors
 import psutil
 from bashlex.errors import ParsingError
 from coloredlogs import logging
-from pydantic import BaseModel, ValidationError
+from pydantic import ValidationError
 
-from client.common import colored, log_output, random_string
+from client.common import colored, log_output
 from client.const import (
     COLORS,
     EXIT_TIMEOUT,
     GENERIC_ERRORS,
     KILL_TIMEOUT,
     LEXER_ERRORS,
+    PARSE_CACHE_SIZE,
+    PROMPT_FD_MIN,
+    READ_BUFFER_SIZE,
     SHELL_INTERACTIVE_COMMANDS,
+    SHELL_RESERVED_WORDS,
     USERTYPES,
 )
 from client.typedefs import (
@@ -49,17 +53,153 @@ from client.typedefs import (
 
 log = logging.getLogger(__name__)
 
+# Prompts are written to the prompt pipe as '<seq>\x1f<prompt>\x1e'
+_PROMPT_END = b'\x1e'
+_PROMPT_RECORD_RE = re.compile(rb'(\d+)\x1f([^\x1f]*)\Z')
+
+# Config files by path, with the (mtime, size) they were loaded at
+_file_cache: dict[str, tuple[tuple[int, int] | None, Any]] = {}
+
+_COMMENT_RE = re.compile(r'^#.*')
+# A single simple command made of plain words, where bashlex would find nothing to object to
+_SIMPLE_COMMAND_RE = re.compile(r'[ \t]*[A-Za-z0-9_./-]+(?:[ \t]+[A-Za-z0-9_./-]+)*[ \t]*')
+# $PS1: '$? \u@\h:\w # '
+_PROMPT_RE = re.compile(
+    r'^(?P<exit_code>[0-9]+) (?P<user>.+)@(?P<host>.+):(?P<cwd>.+) (?P<usertype>[$#]) $'
+)
+
 
 def _dummy_out(message: str) -> list[OutputLine]:
     """Dummy output function."""
-    return [(time.time(), f'/bin/bash: {message}')]
+    return [(time.monotonic_ns(), f'/bin/bash: {message}')]
+
+
+def _split_prompt(prompt: str) -> tuple[str, str, str, str, str] | None:
+    """Split a well-formed prompt into exit code, user, host, cwd and usertype."""
+    code_end = prompt.find(' ')
+    at = prompt.find('@', code_end)
+    colon = prompt.find(':', at)
+    code = prompt[:code_end]
+    # Everything else, e.g. newlines, is left to _PROMPT_RE
+    if (
+        0 < code_end < at - 1 < colon - 2 < len(prompt) - 6
+        and code.isascii()
+        and code.isdigit()
+        and prompt[-3] == ' '
+        and prompt[-2] in USERTYPES
+        and prompt[-1] == ' '
+        and '\n' not in prompt
+    ):
+        return (
+            code,
+            prompt[code_end + 1 : at],
+            prompt[at + 1 : colon],
+            prompt[colon + 1 : -3],
+            prompt[-2],
+        )
+    return None
+
+
+class _OutputStream:
+    """Lines read from one of the shell's output pipes."""
+
+    __slots__ = ('_buffer', '_lines', '_pending', 'fd', 'stream')
+
+    def __init__(self, stream: IO) -> None:
+        """Switch the pipe to non-blocking reads."""
+        self.stream = stream
+        self.fd = stream.fileno()
+        os.set_blocking(self.fd, False)
+        # Read into the same buffer every time instead of allocating a new bytes object per read
+        self._buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+        self._pending = bytearray()
+        self._lines: list[OutputLine] = []
+
+    @property
+    def closed(self) -> bool:
+        """Whether the end of the stream has been reached."""
+        return self.stream.closed
+
+    def read(self) -> int:
+        """Read once from the pipe and return the number of bytes read."""
+        if self.closed:
+            return 0
+        try:
+            n = os.readv(self.fd, [self._buffer])
+        except BlockingIOError:
+            return 0
+        if not n:
+            if self._pending:
+                self._lines.append((time.monotonic_ns(), self._pending.decode('utf-8', 'replace')))
+                self._pending.clear()
+            self.stream.close()
+            return 0
+
+        self._pending.extend(self._buffer[:n])
+        end = self._pending.rfind(b'\n') + 1
+        if end:
+            # Decode all complete lines at once; only the unfinished last line is kept as bytes,
+            # so a character is never split
+            block = self._pending[:end].decode('utf-8', 'replace')
+            del self._pending[:end]
+            # Only used to order the two streams, so it must not jump with the wall clock
+            now = time.monotonic_ns()
+            self._lines.extend((now, f'{line}\n') for line in block[:-1].split('\n'))
+        return n
+
+    def drain(self) -> None:
+        """Read what is in the pipe right now."""
+        # A short read emptied the pipe, anything after it is from a background process that
+        # could keep writing forever
+        while self.read() == len(self._buffer):
+            pass
+
+    def take(self) -> list[OutputLine]:
+        """Take all lines read so far."""
+        lines, self._lines = self._lines, []
+        return lines
+
+
+# The process, its stdin, stdout and stderr, the selector over them, and the read end, shell-side
+# descriptor and received data of the prompt pipe
+_ShellHandles = tuple[
+    subprocess.Popen,
+    IO,
+    _OutputStream,
+    _OutputStream,
+    selectors.BaseSelector,
+    int,
+    int,
+    bytearray,
+]
+
+
+def _read_cached(path: str, load: Callable[[str], Any]) -> Any:
+    """Read and load a file, reusing the previous result while the file is unchanged."""
+    file = Path(path)
+    try:
+        st = file.stat()
+        key = st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+        key = None
+    if path in _file_cache and _file_cache[path][0] == key:
+        return _file_cache[path][1]
+    try:
+        value = load(file.read_text('utf-8'))
+    except (FileNotFoundError, IsADirectoryError):
+        log.debug(f'{path} not found')
+        value = None
+    _file_cache[path] = key, value
+    return value
 
 
-def _enqueue_output(out: IO, queue: Queue[OutputLine]) -> None:
-    """Enqueue output from a stream."""
-    for line in iter(out.readline, b''):
-        queue.put((time.time(), line.decode('utf-8')))
-    out.close()
+def _load_config(content: str) -> LlamaClientConfig | None:
+    """Load the generation config, ignoring it if it is invalid."""
+    try:
+        return LlamaClientConfig.model_validate_json(content)
+    except ValidationError as e:
+        log.debug(f'Invalid config: {e}')
+        return None
 
 
 def _kill_procs(procs: list[psutil.Process], kill: bool = False) -> bool:
@@ -79,64 +219,85 @@ def _kill_procs(procs: list[psutil.Process], kill: bool = False) -> bool:
     return True
 
 
-def _get_commands(command: str) -> list[str]:
-    """Get the nodes of a command."""
-    parsed = bashlex.parse(command)
-
-    class _NodeVisitor(bashlex.ast.nodevisitor):
-        commands: list[bashlex.ast.node]
-
-        def __init__(self, commands: list[bashlex.ast.node]):
-            super().__init__()
-            self.commands = commands
-
-        def visitcommand(self, n: bashlex.ast.node, parts: list[bashlex.ast.node]) -> None:
-            _ = parts
-            self.commands.append(n)
-
-    commands = []
-    visitor = _NodeVisitor(commands)
-    for elem in parsed:
-        visitor.visit(elem)
-
-    return [v.parts[0].word for v in commands]
-
-
-@contextmanager
-def temp_fifo():
-    """Create a temporary FIFO."""
-    tmp = Path(tempfile.mkdtemp())
-    fifo = tmp / random_string(8)
-    with suppress(FileNotFoundError):
-        fifo.unlink()
-    try:
-        os.mkfifo(fifo)
-    except OSError as e:
-        _err = f'Failed to create FIFO: {e}'
-        raise OSError(_err) from e
-    try:
-        log.debug(f'Created FIFO: {fifo}')
-        yield fifo
-    finally:
-        fifo.unlink()
-        tmp.rmdir()
-
-
-class Shell(BaseModel):
+def _child_nodes(n: Any) -> list[Any]:
+    """Get the child nodes of a node, as bashlex's nodevisitor would visit them."""
+    # Nodes keep their fields in __dict__, which depend on the kind, so they are typed as Any
+    if n.kind == 'compound':
+        return [*n.list, *n.redirects]
+    if n.kind == 'redirect':
+        output = n.output if isinstance(n.output, bashlex.ast.node) else None
+        return [v for v in (output, n.heredoc) if v]
+    if n.kind in ('commandsubstitution', 'processsubstitution'):
+        return [n.command]
+    return getattr(n, 'parts', [])
+
+
+def _get_commands(parsed: list[bashlex.ast.node]) -> list[str]:
+    """Get the names of all commands in the parsed nodes, in order."""
+    # Iterative instead of nodevisitor, which dispatches every node through getattr recursively
+    names = []
+    stack: list[Any] = parsed[::-1]
+    while stack:
+        n = stack.pop()
+        if n.kind == 'command':
+            names.append(n.parts[0].word)
+        stack.extend(reversed(_child_nodes(n)))
+    return names
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_commands(command: str) -> tuple[str, ...]:
+    """Get the names of the commands in a command line, raising on syntax errors."""
+    # The model tends to repeat itself, so results are cached; errors are not
+    # Reserved words still go through bashlex, which refuses incomplete compound commands that
+    # would make the shell wait for more input or exit
+    if _SIMPLE_COMMAND_RE.fullmatch(command) and SHELL_RESERVED_WORDS.isdisjoint(command.split()):
+        return tuple(command.split(maxsplit=1)[:1])
+    return tuple(_get_commands(bashlex.parse(command)))
+
+
+class Shell:
     """Interactive shell."""
 
+    __slots__ = (
+        '_prompt_data',
+        '_prompt_fd',
+        '_prompt_fd_shell',
+        '_prompt_seq',
+        '_ps1',
+        '_selector',
+        '_shell',
+        '_stderr',
+        '_stdin',
+        '_stdout',
+    )
+
     _shell: subprocess.Popen
     _stdin: IO
-    _q_stdout: Queue[OutputLine]
-    _q_stderr: Queue[OutputLine]
-    _thread_stdout: threading.Thread
-    _thread_stderr: threading.Thread
+    _stdout: _OutputStream
+    _stderr: _OutputStream
+    _selector: selectors.BaseSelector
+    _prompt_fd: int
+    _prompt_fd_shell: int
+    _prompt_data: bytearray
+    _prompt_seq: int
+    _ps1: str
 
     def __init__(self):
         """Create shell process and streams."""
-        super().__init__()
-        self._open_shell()
-        log.info(f'Shell started with PID {self._shell.pid}')
+        # Bash unsets PS1 on startup because it's not interactive, so it is set for each prompt
+        self._ps1 = os.environ['PS1'].replace('"', '\\"')
+        self._prompt_seq = 0
+        (
+            self._shell,
+            self._stdin,
+            self._stdout,
+            self._stderr,
+            self._selector,
+            self._prompt_fd,
+            self._prompt_fd_shell,
+            self._prompt_data,
+        ) = self._open_shell()
 
     def cleanup(self):
         """Close the shell."""
@@ -152,15 +313,11 @@ class Shell(BaseModel):
 
     def _get_stdout(self) -> list[OutputLine]:
         """Get the stdout from the shell."""
-        stdout = list(self._q_stdout.queue)
-        self._q_stdout.queue.clear()
-        return stdout
+        return self._stdout.take()
 
     def _get_stderr(self) -> list[OutputLine]:
         """Get the stderr from the shell."""
-        stderr = list(self._q_stderr.queue)
-        self._q_stderr.queue.clear()
-        return stderr
+        return self._stderr.take()
 
     def _dummy_result(
         self,
@@ -177,8 +334,8 @@ class Shell(BaseModel):
         _ = self._ensure_shell()
         prompt = self._parse_prompt(self._get_prompt())
         system, goal, config = self._get_config()
-        return ShellResult(
-            command=ShellCommand(command=command),
+        return ShellResult.model_construct(
+            command=ShellCommand.model_construct(command=command),
             stdout=_dummy_out(stdout) if stdout else [],
             stderr=_dummy_out(stderr) if stderr else [],
             exit_code=exit_code,
@@ -190,13 +347,14 @@ class Shell(BaseModel):
 
     def _lex(self, command: str) -> None | ShellResult:
         """Lex a command."""
-        if re.sub(r'^#.*', '', command).strip() == '':
+        if _COMMENT_RE.sub('', command).strip() == '':
             # Bashlex does not handle comments
             return self._dummy_result(command, 0)
 
         exc: tuple[int, str] | None = None
+        commands: tuple[str, ...] = ()
         try:
-            _ = bashlex.parse(command)
+            commands = _parse_commands(command)
         except ParsingError as e:
             if type(e) in LEXER_ERRORS:
                 exc = LEXER_ERRORS[type(e)], e.message
@@ -209,66 +367,81 @@ class Shell(BaseModel):
                 raise
         if exc:
             return self._dummy_result(command, exc[0], stderr=exc[1])
-        commands = _get_commands(command)
-        interactive = ', '.join(set(commands) & set(SHELL_INTERACTIVE_COMMANDS))
+        interactive = [v for v in commands if v in SHELL_INTERACTIVE_COMMANDS]
         if interactive:
-            _err = f'Not a terminal: {interactive}'
+            _err = f'Not a terminal: {", ".join(dict.fromkeys(interactive))}'
             return self._dummy_result(command, -3, stderr=_err)
 
         return None
 
     def _parse_prompt(self, prompt: str) -> Prompt:
         """Parse the prompt."""
-        # $PS1: '$? \u@\h:\w # '
-        match = re.match(
-            r'^(?P<exit_code>[0-9]+) (?P<user>.+)@(?P<host>.+):(?P<cwd>.+) (?P<usertype>[$#]) $',
-            prompt,
-        )
-        if not match:
-            _err = f'Prompt does not match expected format: {prompt}'
-            raise ValueError(_err)
-        groups = match.groupdict()
-        return Prompt.model_validate(
-            {
-                'prompt': prompt,
-                'exit_code': int(groups['exit_code']),
-                'user': groups['user'],
-                'host': groups['host'],
-                'cwd': groups['cwd'],
-                'usertype': USERTYPES[groups['usertype']],
-            }
+        parts = _split_prompt(prompt)
+        if parts is None:
+            match = _PROMPT_RE.match(prompt)
+            if not match:
+                _err = f'Prompt does not match expected format: {prompt}'
+                raise ValueError(_err)
+            parts = match.group('exit_code', 'user', 'host', 'cwd', 'usertype')
+        exit_code, user, host, cwd, usertype = parts
+        # Both parsers already guarantee the types, skip validation
+        return Prompt.model_construct(
+            prompt=prompt,
+            exit_code=int(exit_code),
+            user=user,
+            host=host,
+            cwd=cwd,
+            usertype=USERTYPES[usertype],
         )
 
-    def _open_shell(self):
+    def _open_shell(self) -> _ShellHandles:
         """Open a shell."""
         log.info('Opening shell')
-        self._shell = subprocess.Popen(
-            ['/bin/bash'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            preexec_fn=os.setsid,  # noqa: PLW1509 (unsafe in threads -> not used in thread)
-        )
+        # One pipe for the lifetime of the shell to report prompts on, kept away from the low
+        # descriptors that scripts tend to redirect
+        read_fd, write_fd = os.pipe()
+        prompt_fd_shell = fcntl.fcntl(write_fd, fcntl.F_DUPFD, PROMPT_FD_MIN)
+        os.close(write_fd)
+        try:
+            shell = subprocess.Popen(
+                ['/bin/bash'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                pass_fds=(prompt_fd_shell,),
+                # Same as preexec_fn=os.setsid, but done in C, so subprocess can use vfork
+                start_new_session=True,
+            )
+        finally:
+            # Only the shell writes, so the read end sees EOF once it is gone
+            os.close(prompt_fd_shell)
 
-        if self._streams_gone():
+        if not shell.stdin or not shell.stdout or not shell.stderr:
             _err = 'Shell streams are not available'
             raise ValueError(_err)
-        assert self._shell.stdin is not None
 
-        self._stdin = self._shell.stdin
-        self._q_stdout = Queue()
-        self._q_stderr = Queue()
-        self._thread_stdout = threading.Thread(
-            target=_enqueue_output, args=(self._shell.stdout, self._q_stdout)
-        )
-        self._thread_stderr = threading.Thread(
-            target=_enqueue_output, args=(self._shell.stderr, self._q_stderr)
-        )
-        self._thread_stdout.daemon = True
-        self._thread_stderr.daemon = True
-        self._thread_stdout.start()
-        self._thread_stderr.start()
-        log.info(f'Shell started with PID {self._shell.pid}')
+        stdout = _OutputStream(shell.stdout)
+        stderr = _OutputStream(shell.stderr)
+        # Output is read while waiting for the prompt, so a command can never block on a full pipe
+        selector = selectors.DefaultSelector()
+        _ = selector.register(read_fd, selectors.EVENT_READ)
+        _ = selector.register(stdout.fd, selectors.EVENT_READ, stdout)
+        _ = selector.register(stderr.fd, selectors.EVENT_READ, stderr)
+        log.info(f'Shell started with PID {shell.pid}')
+        return shell, shell.stdin, stdout, stderr, selector, read_fd, prompt_fd_shell, bytearray()
+
+    def _reopen_shell(self) -> None:
+        """Replace the closed shell with a new one."""
+        (
+            self._shell,
+            self._stdin,
+            self._stdout,
+            self._stderr,
+            self._selector,
+            self._prompt_fd,
+            self._prompt_fd_shell,
+            self._prompt_data,
+        ) = self._open_shell()
 
     def _shell_gone(self) -> bool:
         """Check if the shell is gone."""
@@ -281,8 +454,14 @@ class Shell(BaseModel):
     def _wait_shell(self) -> None:
         """Wait for the shell to finish."""
         _ = self._shell.wait()
-        self._thread_stdout.join()
-        self._thread_stderr.join()
+        self._selector.close()
+        with suppress(OSError):
+            os.close(self._prompt_fd)
+        # Don't wait for EOF, background processes may still hold the pipes open
+        self._stdout.drain()
+        self._stderr.drain()
+        self._stdout.stream.close()
+        self._stderr.stream.close()
         stdout = self._get_stdout()
         stderr = self._get_stderr()
         if stdout:
@@ -314,7 +493,7 @@ class Shell(BaseModel):
         if not gone:
             log.error('Failed to close shell')
             return False
-        self._open_shell()
+        self._reopen_shell()
         return True
 
     def _get_shell_children(self) -> list[psutil.Process]:
@@ -322,6 +501,18 @@ class Shell(BaseModel):
         parent = psutil.Process(self._shell.pid)
         return parent.children(recursive=True)
 
+    def _has_shell_children(self) -> bool:
+        """Check if the shell has children without walking the whole process table."""
+        pid = self._shell.pid
+        try:
+            # Direct children are enough, orphaned grandchildren are reparented away from the
+            # shell and wouldn't be found by the recursive walk either
+            children = Path(f'/proc/{pid}/task/{pid}/children').read_bytes()
+        except OSError:
+            # Needs CONFIG_PROC_CHILDREN
+            return bool(self._get_shell_children())
+        return bool(children.strip())
+
     def _kill_shell_children(self, kill: bool = False) -> bool:
         """Kill the shell children."""
         children = self._get_shell_children()
@@ -332,66 +523,88 @@ class Shell(BaseModel):
         if self._shell_gone():
             log.error('Shell has exited')
             self._wait_shell()
-            self._open_shell()
+            self._reopen_shell()
             return False
         return True
 
-    def _wait_done(self, fifo: Path) -> str:
-        """Wait for the shell to finish."""
-        fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
-        try:
-            if not self._ensure_shell():
-                prompt = self._parse_prompt(self._get_prompt())
-                return prompt.prompt
-
-            log.debug(f'Waiting for shell to finish in {EXIT_TIMEOUT} seconds')
-            ready, _, _ = select([fd], [], [], EXIT_TIMEOUT)
+    def _pop_prompt(self, seq: int) -> str | None:
+        """Take the prompt with the given sequence number from the received data."""
+        while (end := self._prompt_data.find(_PROMPT_END)) >= 0:
+            record = bytes(self._prompt_data[:end])
+            del self._prompt_data[: end + 1]
+            # Commands can write to the prompt pipe too, only the record at the end is trusted
+            match = _PROMPT_RECORD_RE.search(record)
+            if match is None:
+                log.warning(f'Malformed prompt record: {record!r}')
+            # Older prompts are left over from commands that timed out
+            elif int(match[1]) == seq:
+                return match[2].decode('utf-8', 'replace')
+        return None
 
-            if not ready:
+    def _wait_done(self, seq: int) -> str:
+        """Wait for the shell to finish."""
+        if not self._ensure_shell():
+            prompt = self._parse_prompt(self._get_prompt())
+            return prompt.prompt
+
+        log.debug(f'Waiting for shell to finish in {EXIT_TIMEOUT} seconds')
+        deadline = time.monotonic() + EXIT_TIMEOUT
+        while (prompt := self._pop_prompt(seq)) is None:
+            # Checked explicitly, a command that keeps printing would never let select time out
+            timeout = deadline - time.monotonic()
+            events = self._selector.select(timeout) if timeout > 0 else []
+
+            if not events:
                 log.error('Shell did not finish in time')
                 if not self._kill_shell_children():
                     log.error('Failed to terminate shell children')
                     _ = self._kill_shell_children(kill=True)
                 ret = self._dummy_result('', -2, stderr='Command timed out')
                 return ret.prompt.prompt
-            return os.read(fd, 1024).decode('utf-8')
-        finally:
-            os.close(fd)
 
-    def _get_prompt(self) -> str:
-        with temp_fifo() as fifo:
-            # Bash unsets PS1 on startup because it's not interactive
-            ps1 = os.environ['PS1'].replace('"', '\\"')
-
-            _ = self._ensure_shell()
-            self._put_stdin(
-                f'(R="$?"; PS1="{ps1}"; (exit "$R"); echo -n "${{PS1@P}}" >> {fifo}; exit "$R")'
-            )
-            ret = self._wait_done(fifo)
-            log.debug(f'Got prompt: {ret}')
-            return ret
+            for key, _ in events:
+                if key.data is not None:
+                    _ = key.data.read()
+                    if key.data.closed:
+                        _ = self._selector.unregister(key.fd)
+                    continue
+                data = os.read(self._prompt_fd, 4096)
+                if not data:
+                    # The shell may still be running, e.g. after 'exec 100>&-', so it can't be
+                    # waited for and has to be replaced
+                    log.error('Shell closed the prompt pipe')
+                    if not self._respawn_shell():
+                        log.error('Failed to respawn shell')
+                        _ = self._respawn_shell(kill=True)
+                    return self._get_prompt()
+                self._prompt_data.extend(data)
+
+        # The command finished writing before the prompt was printed, so the rest of its output
+        # is already in the pipes
+        self._stdout.drain()
+        self._stderr.drain()
+        return prompt
+
+    def _get_prompt(self, command: str | None = None) -> str:
+        """Get the prompt, optionally after running a command first."""
+        _ = self._ensure_shell()
+        self._prompt_seq += 1
+        seq, fd = self._prompt_seq, self._prompt_fd_shell
+        report = (
+            f'(R="$?"; PS1="{self._ps1}"; (exit "$R"); '
+            f'printf \'{seq}\\x1f%s\\x1e\' "${{PS1@P}}" >&{fd}; exit "$R")'
+        )
+        # Bash reads the command and the prompt report from a single write
+        self._put_stdin(report if command is None else f'{command}\n{report}')
+        ret = self._wait_done(seq)
+        log.debug(f'Got prompt: {ret}')
+        return ret
 
     def _get_config(self) -> tuple[str | None, str | None, LlamaClientConfig | None]:
         """Get the system, goal, and config."""
-        try:
-            system = Path('/app/system.md').read_text('utf-8')
-        except (FileNotFoundError, IsADirectoryError):
-            log.debug('System prompt not found')
-            system = None
-        try:
-            goal = Path('/app/goal').read_text('utf-8').strip()
-        except (FileNotFoundError, IsADirectoryError):
-            log.debug('Goal not found')
-            goal = None
-        try:
-            config_json = Path('/app/config.json').read_text('utf-8')
-            config = LlamaClientConfig.model_validate_json(config_json)
-        except (FileNotFoundError, IsADirectoryError):
-            log.debug('Config not found')
-            config = None
-        except ValidationError as e:
-            log.debug(f'Invalid config: {e}')
-            config = None
+        system = _read_cached('/app/system.md', str)
+        goal = _read_cached('/app/goal', str.strip)
+        config = _read_cached('/app/config.json', _load_config)
         return system, goal, config
 
     def _get_base(self) -> BaseResult:
@@ -414,7 +627,7 @@ class Shell(BaseModel):
             _err = 'Shell streams are not available'
             raise ValueError(_err)
 
-        if self._get_shell_children():
+        if self._has_shell_children():
             # Can happen if the model starts background processes
             # TODO: Allow background processes?
             log.error('Shell still has old children')
@@ -422,20 +635,20 @@ class Shell(BaseModel):
                 log.error('Failed to terminate old shell children')
                 _ = self._kill_shell_children(kill=True)
 
-        self._put_stdin(command.command)
-        start = time.time()
-        prompt = self._parse_prompt(self._get_prompt())
-        delta = time.time() - start
+        start = time.monotonic()
+        prompt = self._parse_prompt(self._get_prompt(command.command))
+        delta = time.monotonic() - start
         log.debug(f'Command exited with code {prompt.exit_code} in {delta:.2f}s')
         stdout = self._get_stdout()
         stderr = self._get_stderr()
-        ret = ShellResult(
+        # Built from already validated parts, validating would walk every output line again
+        ret = ShellResult.model_construct(
             command=command,
             stdout=stdout,
             stderr=stderr,
             exit_code=prompt.exit_code,
             prompt=prompt,
-            **self._get_base().model_dump(),
+            **dict(self._get_base()),
         )
         log_output(log.debug, ret)
         return ret
@@ -452,7 +665,7 @@ class Shell(BaseModel):
             FileNotFoundError: 'File not found',
             IsADirectoryError: 'Is a directory',
         }
-        params = {'command': command, 'file': command.file, **self._get_base().model_dump()}
+        params = {'command': command, 'file': command.file, **dict(self._get_base())}
         try:
             if isinstance(command, FileReadCommand):
                 content = Path(command.file).read_text('utf-8')
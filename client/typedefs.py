@@ -1,8 +1,8 @@
 """Common type definitions."""
 
-from typing import Literal
+from typing import Annotated, Any, Literal
 
-from pydantic import BaseModel, RootModel
+from pydantic import BaseModel, Discriminator, RootModel, Tag
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from termcolor._types import Color
 
@@ -18,7 +18,7 @@ class Prompt(BaseModel):
     usertype: Literal['root', 'user']
 
 
-OutputLine = tuple[float, str]
+OutputLine = tuple[int, str]
 
 
 class LlamaClientConfig(BaseSettings):
@@ -74,11 +74,50 @@ class FileWriteCommand(BaseCommand):
 AnyFileCommand = FileReadCommand | FileWriteCommand
 AnyCommand = ShellCommand | FileReadCommand | FileWriteCommand
 
+_META_KINDS = {
+    'FIN': 'FinMessage',
+    'ACK': 'AckMessage',
+    'SYN': 'SynMessage',
+    'NOP': 'NopMessage',
+}
+
+
+def message_kind(value: Any) -> str | None:
+    """Determine the class name of a message from the fields it carries.
+
+    Commands are generated by the model, so there is no explicit tag on the wire. Extra fields
+    are ignored on validation, so e.g. a write command would otherwise also be a valid read.
+    """
+    if isinstance(value, BaseModel):
+        return value.__class__.__name__
+    if not isinstance(value, dict):
+        return None
+    kind = None
+    if 'meta' in value:
+        kind = _META_KINDS.get(value['meta'])
+    elif 'prompt' in value:
+        kind = 'ShellResult'
+    elif 'command' in value and 'file' in value:
+        kind = 'FileWriteResult' if 'written' in value else 'FileReadResult'
+    elif 'command' in value:
+        kind = 'ShellCommand'
+    elif 'file' in value:
+        kind = 'FileWriteCommand' if 'content' in value else 'FileReadCommand'
+    return kind
+
+
+TaggedCommand = Annotated[
+    Annotated[ShellCommand, Tag('ShellCommand')]
+    | Annotated[FileReadCommand, Tag('FileReadCommand')]
+    | Annotated[FileWriteCommand, Tag('FileWriteCommand')],
+    Discriminator(message_kind),
+]
+
 
 class AnyCommands(RootModel):
     """A list of commands."""
 
-    root: list[AnyCommand]
+    root: list[TaggedCommand]
 
 
 class BaseResult(BaseModel):
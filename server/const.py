@@ -1,5 +1,7 @@
 """Constants for the server."""
 
+import os
+
 from client.typedefs import (
     AnyCommands,
     FileReadCommand,
@@ -20,4 +22,7 @@ INITIAL_COMMANDS = AnyCommands(
 )
 
 LLAMA_TOKEN_BUFFER = 512
+# Highlighted commands to keep, most sessions repeat the same few commands
+HIGHLIGHT_CACHE_SIZE = 1024
 LLAMA_AUTOGEN_GRAMMAR = env_bool('LLAMA_AUTOGEN_GRAMMAR', default=True)
+LLAMA_DEFAULT_GOAL = os.environ['LLAMA_DEFAULT_GOAL']
@@ -1,8 +1,8 @@
 """Chat with the Llama using a history of commands."""
 
 import itertools
-import json
-import os
+from bisect import bisect_left
+from operator import itemgetter
 from pathlib import Path
 from typing import overload
 
@@ -19,7 +19,7 @@ from client.typedefs import (
     LlamaClientConfig,
     ShellResult,
 )
-from server.const import LLAMA_TOKEN_BUFFER
+from server.const import LLAMA_DEFAULT_GOAL, LLAMA_TOKEN_BUFFER
 from server.llama_server import LlamaServer
 from server.typedefs import (
     ResultHistory,
@@ -31,6 +31,9 @@ from server.typedefs import (
 
 log = logging.getLogger(__name__)
 
+# Text of an OutputLine, without its timestamp
+_line = itemgetter(1)
+
 
 @overload
 def _simplify(result: ShellResult) -> SimpleShellResult: ...
@@ -45,26 +48,27 @@ def _simplify(result: FileWriteResult) -> SimpleFileWriteResult: ...
 
 
 def _simplify(result: AnyResult) -> SimpleAnyResult:
+    # Empty optional fields are set to None, so they are left out of the serialized result
     if isinstance(result, ShellResult):
         return SimpleShellResult(
             command=result.command.command,
             prompt=result.prompt.prompt,
-            stdout=''.join([v[1] for v in result.stdout]),
-            stderr=''.join([v[1] for v in result.stderr]),
-            exit_code=result.exit_code,
+            stdout=''.join(map(_line, result.stdout)) or None,
+            stderr=''.join(map(_line, result.stderr)) or None,
+            exit_code=result.exit_code or None,
         )
     if isinstance(result, FileReadResult):
         return SimpleFileReadResult(
             file=result.file,
-            content=result.content,
-            error=result.error,
+            content=result.content or None,
+            error=result.error or None,
         )
     if isinstance(result, FileWriteResult):
         return SimpleFileWriteResult(
             file=result.file,
             content=result.command.content,
-            written=result.written,
-            error=result.error,
+            written=result.written or None,
+            error=result.error or None,
         )
     _err = f'Invalid result type: {type(result)}'
     raise ValueError(_err)
@@ -78,27 +82,28 @@ def _from_result(result: AnyResult) -> list[ChatCompletionRequestMessage]:
         },
         {
             'role': 'user',
-            'content': json.dumps(
-                {k: v for k, v in _simplify(result).model_dump().items() if v},
-                indent=2,
-            ),
+            # Straight to JSON, without building a dict of the model first
+            'content': _simplify(result).model_dump_json(indent=2, exclude_none=True),
         },
     ]
 
 
-def _from_commands(results: ResultHistory) -> list[ChatCompletionRequestMessage]:
-    return list(itertools.chain.from_iterable([_from_result(result) for result in results]))
-
-
 class LlamaChat(BaseModel):
     """Chat with the Llama using a history of commands."""
 
     _llama: LlamaServer
     _history: ResultHistory
+    _messages: list[list[ChatCompletionRequestMessage]]
+    _tokens: list[int]
+    _history_tokens: int
     _config: LlamaClientConfig
+    _env_config: LlamaClientConfig
     _system: str
     _goal: str
     _system_mutable: str
+    _system_key: tuple[str, str, str] | None
+    _system_message: ChatCompletionRequestSystemMessage
+    _system_tokens: int
 
     def __init__(self, llama: LlamaServer) -> None:
         """Initialize the Llama chat."""
@@ -106,54 +111,92 @@ class LlamaChat(BaseModel):
         self._llama = llama
 
         self._history = []
-        self._config = LlamaClientConfig()
+        # Messages for each result in the history, converted once when the result is appended
+        self._messages = []
+        # Token count of each entry in the messages, so the history never has to be re-tokenized
+        self._tokens = []
+        # Running sum of the token counts, so checking the fit is a single comparison
+        self._history_tokens = 0
+        # The server's config was loaded from the environment at startup, it is the fallback for
+        # every result without a config
+        self._env_config = self._llama.client_config
+        self._config = self._env_config
         self._system = Path('system.md').read_text(encoding='utf-8')
-        self._goal = os.environ['LLAMA_DEFAULT_GOAL']
+        self._goal = LLAMA_DEFAULT_GOAL
+        # Parts the cached system message was rendered from
+        self._system_key = None
 
     def append_command(self, result: AnyResult) -> None:
         """Add a command to the chat history."""
-        log.debug(f'Appending command: {result}')
-        self._config = result.config or LlamaClientConfig()
-        self._system_mutable = result.system or 'Write your system prompt to /app/system.md.'
-        self._goal = result.goal or os.environ['LLAMA_DEFAULT_GOAL']
-        self._history.append(result)
+        self.append_commands([result])
 
     def append_commands(self, results: list[AnyResult]) -> None:
         """Add multiple commands to the chat history."""
+        if not results:
+            return
         for result in results:
-            self.append_command(result)
+            log.debug('Appending command: %s', result)
+        # Only the last result's settings would survive the batch anyway
+        last = results[-1]
+        self._config = last.config or self._env_config
+        self._system_mutable = last.system or 'Write your system prompt to /app/system.md.'
+        self._goal = last.goal or LLAMA_DEFAULT_GOAL
+        messages = [_from_result(result) for result in results]
+        self._history.extend(results)
+        self._messages.extend(messages)
+        # Counted behind the system prompt the batch ends with, so it is tokenized at most once
+        tokens = [self._count_tokens(v) for v in messages]
+        self._tokens.extend(tokens)
+        self._history_tokens += sum(tokens)
+
+    def _get_system(self) -> tuple[ChatCompletionRequestSystemMessage, int]:
+        """Get the system prompt and its token count, rendering it only when it changed."""
+        key = (self._goal, self._system, self._system_mutable)
+        if key != self._system_key:
+            self._system_message = {
+                'role': 'system',
+                'content': (
+                    f'# Primary goal: {self._goal}\n\n'
+                    f'{self._system}\n\n'
+                    f'=====\n\n'
+                    f'{self._system_mutable}'
+                ),
+            }
+            self._system_tokens = len(self._llama.tokenize([self._system_message], special=True))
+            self._system_key = key
+        return self._system_message, self._system_tokens
 
     @property
     def system(self) -> ChatCompletionRequestSystemMessage:
         """Get the system prompt."""
-        system: ChatCompletionRequestSystemMessage = {
-            'role': 'system',
-            'content': (
-                f'# Primary goal: {self._goal}\n\n'
-                f'{self._system}\n\n'
-                f'=====\n\n'
-                f'{self._system_mutable}'
-            ),
-        }
-        return system
+        return self._get_system()[0]
+
+    def _count_tokens(self, messages: list[ChatCompletionRequestMessage]) -> int:
+        """Count the tokens that messages add to the prompt after the system message."""
+        # Tokenized behind the system message, so template tokens that only the first message
+        # gets are not counted again for every entry
+        system, system_tokens = self._get_system()
+        return len(self._llama.tokenize([system, *messages], special=True)) - system_tokens
 
     def _get_prompt(self) -> list[ChatCompletionRequestMessage]:
         """Get the prompt to chat with the Llama, removing as many tokens as necessary."""
-        system = self.system
+        system, system_tokens = self._get_system()
         n_ctx = self._llama.server_config.n_ctx
-        removed = 0
-        tokens, initial_tokens = None, None
-        while self._history:
-            prompt = [system, *_from_commands(self._history)]
-            tokens = len(self._llama.tokenize(prompt, special=True))
-            if not initial_tokens:
-                initial_tokens = tokens
-            if tokens <= n_ctx - LLAMA_TOKEN_BUFFER:
-                removed_tokens = initial_tokens - tokens
-                log.debug(f'Removed {removed} commands ({removed_tokens} tokens)')
-                return prompt
-            removed += 1
-            log.debug(f'Removed from history: {self._history.pop(0).command}')
+        initial_tokens = system_tokens + self._history_tokens
+        excess = initial_tokens - (n_ctx - LLAMA_TOKEN_BUFFER)
+        if excess <= 0 and self._history:
+            return [system, *itertools.chain.from_iterable(self._messages)]
+        # Fewest entries from the start of the history whose tokens cover the excess
+        removed = bisect_left(list(itertools.accumulate(self._tokens)), excess) + 1
+        for result in self._history[:removed]:
+            log.debug('Removed from history: %s', result.command)
+        removed_tokens = sum(self._tokens[:removed])
+        tokens = initial_tokens - removed_tokens
+        del self._history[:removed], self._messages[:removed], self._tokens[:removed]
+        self._history_tokens -= removed_tokens
+        if self._history:
+            log.debug('Removed %s commands (%s tokens)', removed, removed_tokens)
+            return [system, *itertools.chain.from_iterable(self._messages)]
         _err = f'No commands fit in {n_ctx} tokens (initial: {initial_tokens}, now {tokens})'
         # Happens if the context is small and it runs a command with huge output
         # Not sure how to handle this
@@ -164,5 +207,5 @@ class LlamaChat(BaseModel):
         prompt = self._get_prompt()
         response = self._llama.chat(prompt, self._config)
         ret = expect(response, AnyCommands, log_method=log.debug)
-        log.debug(f'Received {len(ret.root)} commands')
+        log.debug('Received %s commands', len(ret.root))
         return ret
@@ -2,6 +2,7 @@
 
 import json
 import logging
+import os
 from collections.abc import Iterator
 from typing import cast
 
@@ -30,9 +31,10 @@ log = logging.getLogger(__name__)
 
 
 def _config_params(model: BaseSettings) -> dict[str, Any]:
-    ret = {k: v for k, v in model.model_dump().items() if v is not None}
-    for k, v in ret.items():
-        log.debug(f'{model.__class__.__name__}.{k}: {v}')
+    ret = model.model_dump(exclude_none=True)
+    if log.isEnabledFor(logging.DEBUG):
+        for k, v in ret.items():
+            log.debug('%s.%s: %s', model.__class__.__name__, k, v)
     return ret
 
 
@@ -65,14 +67,25 @@ class LlamaServer(BaseModel):
         else:
             log.info('Loading grammar from file')
             self._grammar = LlamaGrammar.from_file(Path('grammar.gbnf'))
-        log.debug(f'Generated grammar: {self._grammar}')
-        self._llm = Llama(**_config_params(self.server_config))
+        log.debug('Generated grammar: %s', self._grammar)
+        params = _config_params(self.server_config)
+        # llama.cpp sizes its threads from the CPU count, which is too many if the process is
+        # restricted to fewer CPUs; only Linux has an affinity mask to check
+        getaffinity = getattr(os, 'sched_getaffinity', None)
+        cpus = os.cpu_count()
+        if getaffinity is not None and cpus is not None:
+            threads = len(getaffinity(0))
+            if threads < cpus:
+                params.setdefault('n_threads', threads)
+                params.setdefault('n_threads_batch', threads)
+        self._llm = Llama(**params)
 
         context = self._llm.metadata.get('llama.context_length')
         if context and self.server_config.n_ctx > int(context):
             log.critical(f'Context length {self.server_config.n_ctx} exceeds metadata {context}')
 
-        log.debug(json.dumps(self._llm.metadata, indent=2))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(json.dumps(self._llm.metadata, indent=2))
         template = self._llm.metadata['tokenizer.chat_template']
 
         try:
@@ -88,7 +101,7 @@ class LlamaServer(BaseModel):
         eos = self._llm._model.token_get_text(eos_id)  # noqa: SLF001 private access
         bos = self._llm._model.token_get_text(bos_id)  # noqa: SLF001 No idea how to fix this
 
-        log.debug(f'Template: {template} (EOS: {eos} {eos_id}, BOS: {bos} {bos_id})')
+        log.debug('Template: %s (EOS: %s %s, BOS: %s %s)', template, eos, eos_id, bos, bos_id)
         self._formatter = Jinja2ChatFormatter(
             template=template,
             eos_token=eos,
@@ -112,11 +125,12 @@ class LlamaServer(BaseModel):
     def chat(self, messages: list[ChatCompletionRequestMessage], config: LlamaClientConfig) -> str:
         """Chat with the model."""
         log.debug('Static parameters:')
-        _ = _config_params(self.client_config)
+        static_params = _config_params(self.client_config)
         log.debug('Dynamic parameters:')
         dynamic_params = _config_params(config)
-        log.debug('Resulting parameters:')
-        params = _config_params(self.client_config.model_copy(update=dynamic_params))
+        # Plain kwargs, so there is no need for a merged copy of the model
+        params = {**static_params, **dynamic_params}
+        log.debug('Resulting parameters: %s', params)
         ret = self._llm.create_chat_completion(
             messages=messages,
             grammar=self._grammar,
@@ -127,9 +141,9 @@ class LlamaServer(BaseModel):
             gen = cast(Iterator[ChatCompletionStreamResponse], ret)
             tokens = []
             for response in gen:
-                if 'content' not in response['choices'][0]['delta']:
+                token = response['choices'][0]['delta'].get('content')
+                if not token:
                     continue
-                token = response['choices'][0]['delta']['content']
                 tokens.append(token)
                 self._streamer.info(token)
             self._streamer.info('\n')
@@ -2,14 +2,30 @@
 
 import logging
 import os
-from socket import AF_INET, SHUT_RDWR, SO_REUSEADDR, SOCK_STREAM, SOL_SOCKET, socket
+from socket import (
+    AF_INET,
+    IPPROTO_TCP,
+    SHUT_RDWR,
+    SO_RCVBUF,
+    SO_REUSEADDR,
+    SO_SNDBUF,
+    SOCK_STREAM,
+    SOL_SOCKET,
+    TCP_NODELAY,
+    socket,
+)
 from types import UnionType
-from typing import get_args, overload
-
-from pydantic import BaseModel
-
-from client.common import DeterminationT, expect, read_message, send_model
-from client.const import EXIT_TIMEOUT
+from typing import Any, cast, overload
+
+from client.common import (
+    DeterminationT,
+    MessageBuffer,
+    expect,
+    flush,
+    read_message,
+    send_model,
+)
+from client.const import EXIT_TIMEOUT, SOCKET_BUFFER_SIZE
 from client.typedefs import (
     AckMessage,
     AnyCommands,
@@ -27,29 +43,46 @@ from server.terminal import Terminal
 log = logging.getLogger(__name__)
 
 
-class Server(BaseModel):
+class Server:
     """Listener for the server."""
 
-    _initialized: bool = False
-    _socket: socket | None = None
+    __slots__ = (
+        '_initialized',
+        '_intro_done',
+        '_llama',
+        '_prompt',
+        '_received',
+        '_socket',
+        '_terminal',
+    )
+
+    _initialized: bool
+    _socket: socket | None
     _llama: LlamaChat
-    _data: bytes = b''
+    _received: MessageBuffer
     _terminal: Terminal
-    _prompt: str | None = None
-    _intro_done: bool = False
+    _prompt: str | None
+    _intro_done: bool
 
     def __init__(self, llama: LlamaChat, terminal: Terminal):
         """Initialize the server."""
-        super().__init__()
         log.info('Starting the server')
+        self._initialized = False
+        self._intro_done = False
+        self._prompt = None
         sock = socket(AF_INET, SOCK_STREAM)
         sock.bind(('127.0.0.1', int(os.getenv('POCKET_ASI_PORT', '1199'))))
         sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        # Inherited by accepted connections, and has to be set before listening for the window
+        # scaling to pick it up
+        sock.setsockopt(SOL_SOCKET, SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(SOL_SOCKET, SO_SNDBUF, SOCKET_BUFFER_SIZE)
         sock.listen()
         log.info(f'Listening on port {sock.getsockname()[1]}')
         self._socket = sock
         self._llama = llama
         self._terminal = terminal
+        self._received = MessageBuffer()
 
     def serve(self):
         """Serve the server."""
@@ -77,18 +110,22 @@ class Server(BaseModel):
             _err = 'Socket is closed'
             raise ConnectionError(_err)
         conn, _ = self._socket.accept()
+        # Commands are batched before sending, so Nagle would only add latency
+        conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
         timeout = EXIT_TIMEOUT + 1
-        log.info(f'Connection accepted from {conn.getpeername()} with timeout {timeout}s')
+        peer = conn.getpeername()
+        log.info('Connection accepted from %s with timeout %ss', peer, timeout)
+        self._received.clear()
         with conn:
             conn.settimeout(timeout)
             _ = self._expect(conn, SynMessage | NopMessage)
             if isinstance(_, NopMessage):
                 log.info('Received NOP, closing connection')
                 return
-            log.debug(f'Received SYN from {conn.getpeername()}')
+            log.debug('Received SYN from %s', peer)
             send_model(conn, AckMessage())
             _ = self._expect(conn, AckMessage)
-            log.debug(f'Received ACK from {conn.getpeername()}, connection established')
+            log.debug('Received ACK from %s, connection established', peer)
 
             if not self._intro_done:
                 self._initial_commands(conn)
@@ -120,13 +157,15 @@ class Server(BaseModel):
 
     def _expect(self, conn: socket, what):
         """Expect a message type."""
-        message = expect(read_message(conn), what, log.debug)
-        if message in get_args(FinMessage):
+        # The client may send FIN instead of whatever was expected
+        message = expect(read_message(conn, self._received), what | FinMessage, log.debug)
+        if isinstance(message, FinMessage):
             log.warning(f'Received FIN from {conn.getpeername()}')
             self.cleanup()
             _err = 'FIN received'
             raise ConnectionError(_err)
-        return message
+        # Anything but FIN is what the caller asked for
+        return cast('Any', message)
 
     def _send_commands(
         self,
@@ -135,14 +174,22 @@ class Server(BaseModel):
     ) -> None:
         """Send commands to the connection."""
         results: list[AnyResult] = []
+        # The client runs commands in the order it receives them, so send the whole batch at
+        # once and only wait for the results
+        outbox: list[bytes] = []
+        for command in llm_commands.root:
+            send_model(conn, command, outbox)
+        flush(conn, outbox)
+        # Suspended for the whole batch, e.g. while the initial commands run
+        render = not self._terminal.suspended
         for command in llm_commands.root:
-            send_model(conn, command)
-            if self._terminal.stream:
+            if render and self._terminal.stream:
                 self._terminal.render_prompt(command=command)
             result = self._expect(conn, AnyResult)
             results.append(result)
-            log.debug(f'Rendering result: {result}')
-            self._terminal.render(self._prompt, result, command.comment)
+            if render:
+                log.debug('Rendering result: %s', result)
+                self._terminal.render(self._prompt, result, command.comment)
             if isinstance(result, ShellResult):
                 self._prompt = result.prompt.prompt
         # Done after the loop to ensure that all commands were successfully executed
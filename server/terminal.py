@@ -1,12 +1,14 @@
 """Pretty output for the interaction."""
 
 import logging
-from typing import cast
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, cast
 
 import pygments
 import pygments.formatters
 import pygments.lexers
-from pydantic import BaseModel
 
 from client.common import colored, log_output
 from client.const import COLORS
@@ -18,32 +20,63 @@ from client.typedefs import (
     ShellCommand,
     ShellResult,
 )
+from server.const import HIGHLIGHT_CACHE_SIZE
 
 log = logging.getLogger(__name__)
 
+_bash_lexer = pygments.lexers.BashLexer()
+_terminal_formatter = pygments.formatters.TerminalFormatter()
 
+
+@lru_cache(maxsize=HIGHLIGHT_CACHE_SIZE)
 def _highlight_bash(command: str | None) -> str:
     """Highlight a bash command."""
     if command is None:
         return ''
-    lexer = pygments.lexers.BashLexer()
-    formatter = pygments.formatters.TerminalFormatter()
     # Remove the trailing newline
-    return pygments.highlight(command, lexer, formatter)[:-1]
+    return pygments.highlight(command, _bash_lexer, _terminal_formatter)[:-1]
+
+
+def _format_shell(command: ShellCommand) -> str:
+    return _highlight_bash(command.command)
+
+
+def _format_read(command: FileReadCommand) -> str:
+    return colored(f'read({command.file})', COLORS.command)
+
 
+def _format_write(command: FileWriteCommand) -> str:
+    return colored(f'write({command.file}, {len(command.content)} bytes)', COLORS.command)
 
-class Terminal(BaseModel):
+
+# Commands are always exactly one of these classes, so the type is looked up directly
+_COMMAND_FORMATTERS: dict[type, Callable[[Any], str]] = {
+    ShellCommand: _format_shell,
+    FileReadCommand: _format_read,
+    FileWriteCommand: _format_write,
+}
+
+
+class Terminal:
     """Pretty output for the interaction."""
 
-    suspended: bool = False
+    __slots__ = ('_handler', '_have_prompt', '_stream', 'suspended')
+
+    suspended: bool
     _stream: bool
-    _streamer: logging.Logger
-    _have_prompt: bool = False
+    _have_prompt: bool
+    _handler: logging.StreamHandler | None
 
     def __init__(self, stream: bool):
         """Initialize the terminal."""
-        super().__init__()
+        self.suspended = False
         self._stream = stream
+        self._have_prompt = False
+        # Hacky, but works - should always be the coloredlogs handler, i.e. StreamHandler
+        # Only needed to keep the prompt on the same line as the streamed command
+        self._handler = None
+        if stream:
+            self._handler = cast(logging.StreamHandler, logging.getLogger().handlers[0])
         log.info(f'Streaming: {self.stream}')
 
     @property
@@ -57,13 +90,8 @@ class Terminal(BaseModel):
             return
         prompt = colored(prompt, COLORS.prompt)
         command_text = ''
-        if isinstance(command, ShellCommand):
-            command_text = _highlight_bash(command.command)
-        elif isinstance(command, FileReadCommand):
-            command_text = colored(f'read({command.file})', COLORS.command)
-        elif isinstance(command, FileWriteCommand):
-            count = len(command.content)
-            command_text = colored(f'write({command.file}, {count} bytes)', COLORS.command)
+        if command is not None:
+            command_text = _COMMAND_FORMATTERS[type(command)](command)
         if self.stream and not command:
             log.info(prompt)
         elif self.stream and not prompt and self._have_prompt:
@@ -84,13 +112,20 @@ class Terminal(BaseModel):
             log.info(comment)
         log_output(log.info, result)
         if self.stream:
-            # Hacky, but works - should always be the coloredlogs handler, i.e. StreamHandler
-            # Remove the newline only for this message so the command can be printed after
-            # the prompt
-            handler = cast(logging.StreamHandler, logging.getLogger().handlers[0])
-            terminator = handler.terminator
-            handler.terminator = ''
             if isinstance(result, ShellResult):
                 prompt = result.prompt.prompt
-            self.render_prompt(prompt=prompt)
-            handler.terminator = terminator
+            with self._no_terminator():
+                self.render_prompt(prompt=prompt)
+
+    @contextmanager
+    def _no_terminator(self) -> Iterator[None]:
+        """Log without a trailing newline, so the command can be printed after the prompt."""
+        if self._handler is None:
+            yield
+            return
+        terminator = self._handler.terminator
+        self._handler.terminator = ''
+        try:
+            yield
+        finally:
+            self._handler.terminator = terminator
@@ -17,6 +17,8 @@ class LlamaServerConfig(BaseSettings):
     n_ctx: int = 8192
     n_gpu_layers: int = -1
     verbose: bool = False
+    # Every turn prefills the whole history, which is faster in bigger batches
+    n_batch: int = 2048
 
     split_mode: int | None = None
     main_gpu: int | None = None
@@ -26,7 +28,6 @@ class LlamaServerConfig(BaseSettings):
     use_mlock: bool | None = None
     # Context Params
     seed: int | None = None
-    n_batch: int | None = None
     n_threads: int | None = None
     n_threads_batch: int | None = None
     rope_scaling_type: int | None = None
@@ -7,7 +7,10 @@ _log() {
 }
 
 _message() {
-    echo "{\"meta\": \"$1\"}" | nc localhost "${LLAMA_PORT:-1199}"
+    # Messages are prefixed with their length as a 4-byte big-endian integer
+    PAYLOAD="{\"meta\": \"$1\"}"
+    printf "\\x00\\x00\\x00\\x$(printf %02x "${#PAYLOAD}")%s" "${PAYLOAD}" \
+        | nc localhost "${LLAMA_PORT:-1199}"
 }
 
 _expect_code() {
@@ -0,0 +1,87 @@
+"""Tests for the shell."""
+
+import select
+import subprocess
+import threading
+import unittest
+
+from bashlex.errors import ParsingError
+
+from client.shell import Shell, _OutputStream, _parse_commands
+from client.typedefs import ShellCommand, ShellResult
+
+
+class _LexOnlyShell(Shell):
+    """Shell that reports refusals without starting bash."""
+
+    def __init__(self) -> None:
+        """Skip starting the shell, lexing does not need it."""
+
+    def _dummy_result(
+        self,
+        command: str,
+        exit_code: int,
+        stdout: str | None = None,
+        stderr: str | None = None,
+    ) -> ShellResult:
+        _ = stdout, stderr
+        return ShellResult.model_construct(
+            command=ShellCommand.model_construct(command=command), exit_code=exit_code
+        )
+
+
+class TestLex(unittest.TestCase):
+    """Commands that must be refused before they reach bash."""
+
+    def test_plain_words(self) -> None:
+        """Plain words take the fast path."""
+        self.assertEqual(_parse_commands('ls -la /tmp'), ('ls',))
+        self.assertIsNone(_LexOnlyShell()._lex('git status'))  # noqa: SLF001 private access
+
+    def test_reserved_words_refused(self) -> None:
+        """Incomplete compound commands are syntax errors, not commands."""
+        for command in ('fi', 'done', 'if x', 'for x in y', 'while true', 'then'):
+            with self.subTest(command=command):
+                with self.assertRaises(ParsingError):
+                    _ = _parse_commands(command)
+                result = _LexOnlyShell()._lex(command)  # noqa: SLF001 private access
+                self.assertIsNotNone(result)
+                assert result is not None
+                self.assertEqual(result.exit_code, 2)
+
+
+class TestPromptRecords(unittest.TestCase):
+    """Prompt records read from the prompt pipe."""
+
+    def test_malformed_records_skipped(self) -> None:
+        """Records that don't parse are dropped instead of raising."""
+        shell = _LexOnlyShell()
+        data = bytearray(b'junk\x1e1\x1fold\x1eoops2\x1f$ \x1e')
+        shell._prompt_data = data  # noqa: SLF001 private access
+        self.assertEqual(shell._pop_prompt(2), '$ ')  # noqa: SLF001 private access
+        self.assertFalse(data)
+
+
+class TestOutputStream(unittest.TestCase):
+    """Reading the shell's output pipes."""
+
+    def test_drain_with_background_writer(self) -> None:
+        """Draining returns even if a background process keeps the pipe full."""
+        with subprocess.Popen(['/usr/bin/yes'], stdout=subprocess.PIPE) as writer:
+            try:
+                assert writer.stdout is not None
+                stream = _OutputStream(writer.stdout)
+                _ = select.select([stream.fd], [], [], 5)
+                drain = threading.Thread(target=stream.drain, daemon=True)
+                drain.start()
+                drain.join(5)
+                self.assertFalse(drain.is_alive())
+                lines = stream.take()
+                self.assertTrue(lines)
+                self.assertEqual(lines[0][1], 'y\n')
+            finally:
+                writer.kill()
+
+
+if __name__ == '__main__':
+    _ = unittest.main()